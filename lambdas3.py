@@ -1,10 +1,19 @@
-import os, json, time, hashlib, urllib.parse, sys, logging
+import os, json, time, hashlib, threading, urllib.parse, sys, logging
+from contextlib import suppress
 from datetime import date
 import boto3
+from botocore.config import Config
 from botocore.exceptions import BotoCoreError, ClientError
 
-ATHENA = boto3.client("athena")
-S3 = boto3.client("s3")
+# Adaptive retries absorb Athena/S3 throttling; keepalive avoids idle NAT drops while polling
+_CLIENT_CONFIG = Config(
+    max_pool_connections=64,
+    retries={"max_attempts": 10, "mode": "adaptive"},
+    tcp_keepalive=True,
+)
+ATHENA = boto3.client("athena", config=_CLIENT_CONFIG)
+S3 = boto3.client("s3", config=_CLIENT_CONFIG)
+LAMBDA = boto3.client("lambda", config=_CLIENT_CONFIG)
 
 #  Logging
 log = logging.getLogger("on_upload_count_accredited")
@@ -14,54 +23,84 @@ if not log.handlers:
     log.addHandler(h)
 log.setLevel(logging.INFO)
 
+_ENCODER = json.JSONEncoder(separators=(",", ":"))
+
 #  Env vars (set these in Lambda > Configuration > Environment variables) 
 ATHENA_DATABASE   = os.environ["ATHENA_DATABASE"]     # e.g., "medlaunch_db"
 ATHENA_TABLE      = os.environ["ATHENA_TABLE"]        # e.g., "facilities_raw"
 ATHENA_WORKGROUP  = os.environ.get("ATHENA_WORKGROUP", "primary")
 RESULTS_S3_PREFIX = os.environ["RESULTS_S3_PREFIX"]   # e.g., "s3://medlaunch/exports/state_counts/"
 # Optional: UNLOAD format controls
-UNLOAD_FORMAT     = os.environ.get("UNLOAD_FORMAT", "TEXTFILE")   # TEXTFILE for CSV-ish text
-UNLOAD_DELIM      = os.environ.get("UNLOAD_DELIM", ",")
-UNLOAD_COMPRESSION= os.environ.get("UNLOAD_COMPRESSION", "NONE")  # NONE for previewable
+UNLOAD_FORMAT     = os.environ.get("UNLOAD_FORMAT", "TEXTFILE").upper()  # TEXTFILE for CSV-ish text, PARQUET for columnar
+UNLOAD_DELIM      = os.environ.get("UNLOAD_DELIM", ",")                  # TEXTFILE only
+UNLOAD_COMPRESSION= os.environ.get("UNLOAD_COMPRESSION",
+                                   "NONE" if UNLOAD_FORMAT == "TEXTFILE" else "SNAPPY")  # NONE for previewable
+# Optional: Athena status poll backoff in seconds (small/result-reuse queries finish in ~200ms)
+POLL_INITIAL      = float(os.environ.get("ATHENA_POLL_INITIAL", "0.25"))
+POLL_MAX          = float(os.environ.get("ATHENA_POLL_MAX", "3.0"))
+
+#  Connection prewarm 
+# Open the TLS connections during Lambda init so the first real call skips the handshake.
+# Any response (including AccessDenied) leaves a pooled connection behind. Only runs inside
+# Lambda; the join is bounded so an unreachable endpoint can't stall init via the retry policy.
+def _prewarm():
+    with suppress(BotoCoreError, ClientError):
+        ATHENA.list_work_groups(MaxResults=1)
+    results_bucket = urllib.parse.urlparse(RESULTS_S3_PREFIX).netloc
+    if results_bucket:
+        with suppress(BotoCoreError, ClientError):
+            S3.head_bucket(Bucket=results_bucket)
+
+if os.environ.get("AWS_LAMBDA_FUNCTION_NAME"):
+    _t = threading.Thread(target=_prewarm, daemon=True)
+    _t.start()
+    _t.join(1.0)
 
 #  SQL builders 
-def build_sql(today_str: str) -> str:
-    return f"""
-UNLOAD (
+# Database/table and UNLOAD format are fixed per deployment, so they are baked in once at
+# import; only the date and output location vary per call.
+_STATE_COUNTS_SQL = """
+      SELECT r.location.state AS state,
+             COUNT(DISTINCT r.facility_id) AS accredited_facilities
+      FROM """ + ATHENA_DATABASE + "." + ATHENA_TABLE + """ r
+      CROSS JOIN UNNEST(r.accreditations) AS t(a)
+      WHERE CAST(a.valid_until AS DATE) >= DATE '{today}'
+      GROUP BY r.location.state"""
+
+if UNLOAD_FORMAT == "TEXTFILE":
+    # Text output has no column names, so a header row is unioned in and sorted first
+    _UNLOAD_SELECT = """
   SELECT *
   FROM (
     SELECT 0 AS _order, 'state' AS state, 'accredited_facilities' AS accredited_facilities
     UNION ALL
     SELECT 1 AS _order, state, CAST(accredited_facilities AS VARCHAR)
-    FROM (
-      SELECT r.location.state AS state,
-             COUNT(DISTINCT r.facility_id) AS accredited_facilities
-      FROM {ATHENA_DATABASE}.{ATHENA_TABLE} r
-      CROSS JOIN UNNEST(r.accreditations) AS t(a)
-      WHERE CAST(a.valid_until AS DATE) >= DATE '{today_str}'
-      GROUP BY r.location.state
+    FROM (""" + _STATE_COUNTS_SQL + """
     ) s
   ) out
-  ORDER BY _order, state
-)
-TO '{{OUTPUT}}'
-WITH (format='TEXTFILE', field_delimiter=',', compression='NONE')
-""".strip()
+  ORDER BY _order, state"""
+    _UNLOAD_WITH = f"format='TEXTFILE', field_delimiter='{UNLOAD_DELIM}', compression='{UNLOAD_COMPRESSION}'"
+else:
+    # Columnar formats carry their own schema and keep the count typed
+    _UNLOAD_SELECT = _STATE_COUNTS_SQL
+    _UNLOAD_WITH = f"format='{UNLOAD_FORMAT}', compression='{UNLOAD_COMPRESSION}'"
+
+_SQL_TEMPLATE = "UNLOAD (" + _UNLOAD_SELECT + "\n)\nTO '{output}'\nWITH (" + _UNLOAD_WITH + ")"
 
-def results_prefix_for_object(src_bucket: str, src_key: str) -> str:
+def build_sql(today_str: str, output_location: str) -> str:
+    return _SQL_TEMPLATE.format(today=today_str, output=output_location.rstrip("/") + "/")
+
+def results_prefix_for_object(src_bucket: str, src_key: str, today_str: str) -> str:
     # Example:
     # s3://medlaunch/exports/state_counts/<bucket>/<urlencoded-key>/<YYYY-MM-DD>/
-    today = date.today().isoformat()
     enc_key = urllib.parse.quote(src_key, safe="")
     base = RESULTS_S3_PREFIX.rstrip("/")
-    return f"{base}/{src_bucket}/{enc_key}/{today}/"
+    return f"{base}/{src_bucket}/{enc_key}/{today_str}/"
 
 #  Athena helpers 
 def start_unload(query: str, workgroup: str, output_location: str, token: str) -> str:
-    # Substitute target output into query template
-    q = query.replace("{OUTPUT}", output_location.rstrip("/") + "/")
     resp = ATHENA.start_query_execution(
-        QueryString=q,
+        QueryString=query,
         QueryExecutionContext={"Database": ATHENA_DATABASE},
         ResultConfiguration={"OutputLocation": output_location},
         WorkGroup=workgroup,
@@ -70,78 +109,111 @@ def start_unload(query: str, workgroup: str, output_location: str, token: str) -
     return resp["QueryExecutionId"]
 
 def wait_for_query(qid: str, context) -> str:
-    delay = 1.0
+    get_remaining_ms = getattr(context, "get_remaining_time_in_millis", lambda: 30000)
+    delay = POLL_INITIAL
     while True:
         resp = ATHENA.get_query_execution(QueryExecutionId=qid)
         state = resp["QueryExecution"]["Status"]["State"]
         if state in ("SUCCEEDED", "FAILED", "CANCELLED"):
             return state
-        # Avoid Lambda timeout; leave ~10s headroom
-        remaining_ms = getattr(context, "get_remaining_time_in_millis", lambda: 30000)()
+        # Avoid Lambda timeout; leave ~10s headroom (checked every poll, since a throttled
+        # GetQueryExecution can take seconds under adaptive retries)
+        remaining_ms = get_remaining_ms()
         if remaining_ms < 10000:
-            log.warning("Exiting early to avoid timeout; letting retry handle continuation",
+            log.warning("Exiting early to avoid timeout; handing the query to a new invocation",
                         extra={"query_id": qid, "remaining_ms": remaining_ms})
             raise TimeoutError(f"Query still running: {qid}")
         time.sleep(delay)
-        delay = min(delay * 1.7, 10.0)
+        delay = min(delay * 1.25, POLL_MAX)
 
 def put_marker(bucket: str, key: str, data: dict):
     S3.put_object(Bucket=bucket, Key=key,
-                  Body=json.dumps(data, separators=(",", ":")).encode("utf-8"),
+                  Body=_ENCODER.encode(data).encode("utf-8"),
                   ContentType="application/json")
 
+def finish_unload(job: dict, context):
+    qid = job["query_execution_id"]
+    state = wait_for_query(qid, context)
+    log.info(f"Athena UNLOAD finished: {state} (QueryExecutionId={qid})")
+
+    if state != "SUCCEEDED":
+        raise RuntimeError(f"Athena query did not succeed: {qid} state={state}")
+
+    # Optional: write a marker for easy traceability
+    out_bucket = job["output_prefix"].split("/", 3)[2]
+    out_key_prefix = job["output_prefix"].split("/", 3)[3]
+    put_marker(out_bucket, f"{out_key_prefix}marker.json", {**job, "status": "SUCCEEDED"})
+
+def continue_in_new_invocation(context, job: dict, records: list):
+    # Pass the running query (and any records not started yet) to an async self-invocation,
+    # so the UNLOAD is not re-submitted by a Lambda retry
+    LAMBDA.invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType="Event",
+        Payload=_ENCODER.encode({"resume": job, "Records": records}).encode("utf-8"),
+    )
+    log.info(f"Continuing {job['query_execution_id']} in a new invocation "
+             f"with {len(records)} pending record(s)")
+
 #  Lambda entry 
 def lambda_handler(event, context):
-    # Expect S3 Put event(s)
-    records = event.get("Records", []) if isinstance(event, dict) else []
-    if not records:
+    # Expect S3 Put event(s), or a continuation carrying a still-running query under "resume"
+    event = event if isinstance(event, dict) else {}
+    records = event.get("Records", [])
+    resume = event.get("resume")
+    if not records and not resume:
         log.info("No Records in event; nothing to do.")
         return {"ok": True}
 
-    for rec in records:
-        if rec.get("eventSource") != "aws:s3":
-            continue
-        src_bucket = rec["s3"]["bucket"]["name"]
-        src_key = urllib.parse.unquote_plus(rec["s3"]["object"]["key"])
-        log.info(f"Triggered by s3://{src_bucket}/{src_key}")
+    job, pending = resume, records
 
-        today_str = date.today().isoformat()
-        sql = build_sql(today_str)
-        output_prefix = results_prefix_for_object(src_bucket, src_key)  # where CSV will land
+    # Athena will also put its own small artifacts in the workgroup output location;
+    # the actual CSV data files are written under 'output_prefix' by UNLOAD.
+    try:
+        if job:
+            log.info(f"Resuming Athena UNLOAD {job['query_execution_id']}")
+            finish_unload(job, context)
 
-        # Idempotency: hash of bucket+key+sql
-        token = hashlib.sha256((src_bucket + "|" + src_key + "|" + sql).encode("utf-8")).hexdigest()
+        for i, rec in enumerate(records):
+            if rec.get("eventSource") != "aws:s3":
+                continue
+            src_bucket = rec["s3"]["bucket"]["name"]
+            src_key = urllib.parse.unquote_plus(rec["s3"]["object"]["key"])
+            log.info(f"Triggered by s3://{src_bucket}/{src_key}")
+
+            # One date per record (an invocation can run past midnight) feeds the SQL filter,
+            # the output prefix, the token and the marker
+            today_str = date.today().isoformat()
+            output_prefix = results_prefix_for_object(src_bucket, src_key, today_str)  # where CSV will land
+            sql = build_sql(today_str, output_prefix)
+
+            # Idempotency: build_sql and the output prefix are both derived from bucket+key+today_str
+            # (plus deployment config), so the same token always maps to the same statement
+            token = hashlib.sha256(f"{src_bucket}|{src_key}|{today_str}".encode("utf-8")).hexdigest()
 
-        # Athena will also put its own small artifacts in the workgroup output location;
-        # the actual CSV data files are written under 'output_prefix' by UNLOAD.
-        try:
             qid = start_unload(sql, ATHENA_WORKGROUP, output_prefix, token)
-            state = wait_for_query(qid, context)
-            log.info(f"Athena UNLOAD finished: {state} (QueryExecutionId={qid})")
-
-            if state != "SUCCEEDED":
-                raise RuntimeError(f"Athena query did not succeed: {qid} state={state}")
-            
-            # Optional: write a marker for easy traceability
-            out_bucket = output_prefix.split("/", 3)[2]
-            out_key_prefix = output_prefix.split("/", 3)[3]
-            put_marker(out_bucket, f"{out_key_prefix}marker.json", {
+            job, pending = {
                 "source_bucket": src_bucket,
                 "source_key": src_key,
                 "date": today_str,
                 "query_execution_id": qid,
                 "output_prefix": output_prefix,
-                "status": "SUCCEEDED"
-            })
+            }, records[i + 1:]
+            finish_unload(job, context)
 
+    except TimeoutError as e:
+        log.warning(f"Timeout; chaining continuation: {e}")
+        try:
+            continue_in_new_invocation(context, job, pending)
         except (BotoCoreError, ClientError) as e:
             log.error(f"AWS client error: {e}")
             raise
-        except TimeoutError as e:
-            log.warning(f"Timeout; allowing retry: {e}")
-            raise
-        except Exception as e:
-            log.error(f"Unhandled error: {e}")
-            raise
-
-    return {"ok": True}
\ No newline at end of file
+        return {"ok": True, "continued": job["query_execution_id"]}
+    except (BotoCoreError, ClientError) as e:
+        log.error(f"AWS client error: {e}")
+        raise
+    except Exception as e:
+        log.error(f"Unhandled error: {e}")
+        raise
+
+    return {"ok": True}
@@ -1,9 +1,14 @@
-import os, json, sys, logging
+import os, re, csv, gzip, json, sys, codecs, tempfile, threading, logging
+from contextlib import suppress
 from datetime import date, timedelta
-from typing import List, Dict, Any, Optional, Generator
+from typing import Dict, Any, Generator
 from urllib.parse import unquote_plus
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 
 import boto3
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import BotoCoreError, ClientError
 
 #  Logging 
@@ -14,68 +19,150 @@ if not logger.handlers:
     logger.addHandler(h)
 logger.setLevel(logging.INFO)
 
-s3 = boto3.client("s3")
+MAX_WORKERS = int(os.environ.get("MAX_WORKERS", "16"))  # concurrent objects in a prefix scan
+# Optional: read keys from the latest S3 Inventory (CSV) instead of LIST for very large prefixes.
+# INVENTORY_PREFIX is the inventory config folder, e.g. s3://inv-bucket/inventory/medlaunch/all-objects/
+USE_S3_INVENTORY = os.environ.get("USE_S3_INVENTORY") == "1"
+INVENTORY_PREFIX = os.environ.get("INVENTORY_PREFIX", "")
+
+s3 = boto3.client("s3", config=Config(
+    max_pool_connections=64,
+    retries={"max_attempts": 10, "mode": "adaptive"},
+    tcp_keepalive=True,
+))
+
+# Open the TLS connection during Lambda init so the first GET/LIST skips the handshake.
+# Only runs inside Lambda; the join is bounded so an unreachable endpoint can't stall init
+# via the retry policy.
+def _prewarm():
+    with suppress(BotoCoreError, ClientError):
+        s3.head_bucket(Bucket=os.environ.get("BUCKET", ""))
+
+if os.environ.get("AWS_LAMBDA_FUNCTION_NAME") and os.environ.get("BUCKET"):
+    _t = threading.Thread(target=_prewarm, daemon=True)
+    _t.start()
+    _t.join(1.0)
+
+# Filtered output: each worker spools in memory up to its share of a 64MB budget, then
+# moves to /tmp; uploads go in 8MB multipart chunks. Concurrency comes from run_job's
+# pool, so each upload stays single-threaded.
+SPOOL_BUDGET_BYTES = 64 * 1024 * 1024
+SPOOL_MAX_BYTES = max(1024 * 1024, SPOOL_BUDGET_BYTES // MAX_WORKERS)
+UPLOAD_PART_BYTES = 8 * 1024 * 1024
+UPLOAD_CONFIG = TransferConfig(multipart_threshold=UPLOAD_PART_BYTES,
+                               multipart_chunksize=UPLOAD_PART_BYTES, use_threads=False)
 
 #  Parsing helpers 
-def _iter_ndjson(text: str) -> Optional[List[Dict[str, Any]]]:
-    recs = []
-    lines = [ln for ln in text.splitlines() if ln.strip()]
-    if not lines:
-        return []
-    try:
-        for ln in lines:
-            recs.append(json.loads(ln))
-        return recs
-    except json.JSONDecodeError:
-        return None
+CHUNK_SIZE = 1024 * 1024  # bytes pulled from the S3 stream per read
+MAX_RECORD_CHARS = 64 * 1024 * 1024  # largest single NDJSON/concatenated record accepted
+_NON_WS = re.compile(r"\S")
+_DECODER = json.JSONDecoder()
+_ENCODER = json.JSONEncoder(separators=(",", ":"))  # compact NDJSON; reused instead of per-call json.dumps
 
-def _parse_json_array(text: str) -> Optional[List[Dict[str, Any]]]:
-    try:
-        obj = json.loads(text)
-        return obj if isinstance(obj, list) else None
-    except json.JSONDecodeError:
-        return None
+def iter_records(stream, chunk_size: int = CHUNK_SIZE) -> Generator[Dict[str, Any], None, None]:
+    # Single streaming pass over a JSON array, NDJSON, or concatenated JSON objects.
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    while not buf.strip():
+        chunk = stream.read(chunk_size)
+        if not chunk: return
+        buf += decoder.decode(chunk)
+    buf = buf.lstrip()
 
-def _iter_concatenated(text: str) -> Optional[List[Dict[str, Any]]]:
-    dec = json.JSONDecoder(); idx = 0; n = len(text); recs = []
-    try:
-        while idx < n:
-            while idx < n and text[idx].isspace():
-                idx += 1
-            if idx >= n: break
-            obj, next_idx = dec.raw_decode(text, idx)
-            recs.append(obj); idx = next_idx
-        return recs
-    except json.JSONDecodeError:
-        return None
-
-def detect_and_extract_records(text: str) -> List[Dict[str, Any]]:
-    for parser in (_iter_ndjson, _parse_json_array, _iter_concatenated):
-        res = parser(text)
-        if res is not None:
-            return res
-    raise ValueError("Unable to parse as NDJSON, JSON array, or concatenated JSON objects.")
+    if buf[0] == "[":
+        # An array is one document; it has to be parsed as a whole
+        buf += decoder.decode(stream.read(), final=True)
+        yield from json.loads(buf)
+        return
+
+    raw_decode, search = _DECODER.raw_decode, _NON_WS.search
+    idx = 0; eof = False
+    while True:
+        want = chunk_size
+        m = search(buf, idx)
+        if m:
+            idx = m.start()
+            try:
+                obj, end = raw_decode(buf, idx)
+            except json.JSONDecodeError:
+                if eof: raise
+                # Incomplete (or malformed) value: grow the read geometrically so re-parsing
+                # the pending tail stays linear overall, and give up past MAX_RECORD_CHARS
+                if len(buf) - idx > MAX_RECORD_CHARS:
+                    raise ValueError(f"Unparseable record larger than {MAX_RECORD_CHARS} chars")
+                want = max(chunk_size, len(buf) - idx)
+            else:
+                # A value ending exactly at the buffer end may be a truncated scalar (e.g. "123"
+                # of "12345"); only trust it once more input or EOF follows
+                if eof or end < len(buf):
+                    yield obj; idx = end
+                    continue
+        elif eof:
+            return
+        else:
+            idx = len(buf)
+        # Value straddles the chunk boundary (or buffer drained); pull more bytes
+        chunk = stream.read(want)
+        eof = not chunk
+        buf = buf[idx:] + decoder.decode(chunk, final=eof); idx = 0
 
 #  Date / filter 
-from datetime import date
-def _parse_iso_date(s: str):
-    if not s: return None
-    s = s.strip()[:10]
-    try: return date.fromisoformat(s)
-    except Exception: return None
-
-def accreditation_expires_within(record: Dict[str, Any], threshold: date, today: date) -> bool:
-    for acc in (record.get("accreditations") or []):
-        d = _parse_iso_date(acc.get("valid_until"))
-        if d and today <= d <= threshold:
-            return True
-    return False
+# valid_until is ISO-8601, so comparing the YYYY-MM-DD prefix as a string matches date order
+def accreditation_expires_within(record: Dict[str, Any], threshold_iso: str, today_iso: str) -> bool:
+    return any(today_iso <= (acc.get("valid_until") or "")[:10] <= threshold_iso
+               for acc in (record.get("accreditations") or ()))
 
 #  IO -
+_INVENTORY_RUN = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}-\d{2}Z/$")
+
+def _inventory_keys(bucket: str, prefix: str) -> Generator[str, None, None]:
+    inv_bucket, _, inv_prefix = INVENTORY_PREFIX.partition("s3://")[2].partition("/")
+    if not INVENTORY_PREFIX.startswith("s3://") or not inv_bucket:
+        raise ValueError(f"USE_S3_INVENTORY=1 needs INVENTORY_PREFIX=s3://<bucket>/<prefix>/, got {INVENTORY_PREFIX!r}")
+    inv_prefix = inv_prefix.rstrip("/") + "/"
+
+    # Each delivery lands in a timestamped folder; the lexically last one is the newest
+    runs = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=inv_bucket, Prefix=inv_prefix, Delimiter="/"):
+        for cp in page.get("CommonPrefixes", []):
+            if _INVENTORY_RUN.search(cp["Prefix"]):
+                runs.append(cp["Prefix"])
+    if not runs:
+        raise ValueError(f"No inventory deliveries under {INVENTORY_PREFIX}")
+    manifest_key = max(runs) + "manifest.json"
+    manifest = json.load(s3.get_object(Bucket=inv_bucket, Key=manifest_key)["Body"])
+    if manifest.get("fileFormat") != "CSV":
+        raise ValueError(f"Unsupported inventory format {manifest.get('fileFormat')}; only CSV is supported")
+    if manifest.get("sourceBucket") != bucket:
+        raise ValueError(f"Inventory {manifest_key} is for bucket {manifest.get('sourceBucket')}, not {bucket}")
+    logger.info(f"Listing keys from inventory s3://{inv_bucket}/{manifest_key}")
+
+    schema = [c.strip() for c in manifest["fileSchema"].split(",")]
+    key_col = schema.index("Key")
+    # Versioned inventories list every version and delete marker; keep only live current objects
+    latest_col = schema.index("IsLatest") if "IsLatest" in schema else None
+    marker_col = schema.index("IsDeleteMarker") if "IsDeleteMarker" in schema else None
+    for f in manifest["files"]:
+        body = s3.get_object(Bucket=inv_bucket, Key=f["key"])["Body"]
+        with gzip.open(body, "rt", encoding="utf-8", newline="") as fh:
+            for row in csv.reader(fh):
+                if latest_col is not None and row[latest_col] != "true":
+                    continue
+                if marker_col is not None and row[marker_col] == "true":
+                    continue
+                k = unquote_plus(row[key_col])  # inventory CSV keys are URL-encoded
+                if k.startswith(prefix) and not k.endswith("/"):
+                    yield k
+
 def list_keys(bucket: str, prefix: str) -> Generator[str, None, None]:
+    if USE_S3_INVENTORY:
+        # A misconfigured or unreadable inventory must fail the run, not look like an empty prefix
+        yield from _inventory_keys(bucket, prefix)
+        return
     paginator = s3.get_paginator("list_objects_v2")
     try:
-        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix, PaginationConfig={"PageSize": 1000}):
             for obj in page.get("Contents", []):
                 k = obj["Key"]
                 if not k.endswith("/"):
@@ -83,43 +170,54 @@ def list_keys(bucket: str, prefix: str) -> Generator[str, None, None]:
     except (BotoCoreError, ClientError) as e:
         logger.error(f"Failed to list s3://{bucket}/{prefix}: {e}")
 
-def process_object(bucket: str, key: str, out_prefix: str, threshold: date, today: date) -> int:
+def process_object(bucket: str, key: str, out_prefix: str, threshold_iso: str, today_iso: str) -> int:
     logger.info(f"Reading s3://{bucket}/{key}")
-    try:
-        body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
-        text = body.decode("utf-8")
-        records = detect_and_extract_records(text)
-    except (BotoCoreError, ClientError) as e:
-        logger.error(f"Read error {key}: {e}"); return 0
-    except UnicodeDecodeError:
-        logger.error(f"Non-UTF8 file: {key}"); return 0
-    except Exception as e:
-        logger.error(f"Parse error {key}: {e}"); return 0
-
-    filtered = [r for r in records if accreditation_expires_within(r, threshold, today)]
-    if not filtered:
-        logger.info(f"No expiring records in {key}")
-        return 0
-
-    ndjson_payload = "\n".join(json.dumps(r, separators=(",", ":")) for r in filtered)
     base = key.rsplit("/", 1)[-1].rsplit(".", 1)[0]
     out_key = out_prefix.rstrip("/") + f"/{base}_filtered.ndjson"
-    try:
-        s3.put_object(
-            Bucket=bucket,
-            Key=out_key,
-            Body=ndjson_payload.encode("utf-8"),
-            ContentType="application/x-ndjson",
-        )
-        logger.info(f"Wrote {len(filtered)} -> s3://{bucket}/{out_key}")
-        return len(filtered)
-    except (BotoCoreError, ClientError) as e:
-        logger.error(f"Write error {key}: {e}"); return 0
+    encode = _ENCODER.encode
+    buf = bytearray(); extend = buf.extend
+    written = 0
+
+    # Matches are batched in buf and flushed to the spool every CHUNK_SIZE bytes; the spool
+    # stays in memory up to SPOOL_MAX_BYTES and then moves to /tmp, so peak RAM doesn't grow
+    # with the output
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES) as out:
+        try:
+            body = s3.get_object(Bucket=bucket, Key=key)["Body"]
+            for r in iter_records(body):
+                if accreditation_expires_within(r, threshold_iso, today_iso):
+                    if written: extend(b"\n")
+                    extend(encode(r).encode("utf-8"))
+                    written += 1
+                    if len(buf) >= CHUNK_SIZE:
+                        out.write(buf); buf.clear()
+            out.write(buf)
+        except (BotoCoreError, ClientError) as e:
+            logger.error(f"Read error {key}: {e}"); return 0
+        except UnicodeDecodeError:
+            logger.error(f"Non-UTF8 file: {key}"); return 0
+        except Exception as e:
+            logger.error(f"Parse error {key}: {e}"); return 0
+
+        if not written:
+            logger.info(f"No expiring records in {key}")
+            return 0
+
+        out.seek(0)
+        try:
+            s3.upload_fileobj(out, bucket, out_key,
+                              ExtraArgs={"ContentType": "application/x-ndjson"},
+                              Config=UPLOAD_CONFIG)
+            logger.info(f"Wrote {written} -> s3://{bucket}/{out_key}")
+            return written
+        except (BotoCoreError, ClientError, S3UploadFailedError) as e:
+            logger.error(f"Write error {key}: {e}"); return 0
 
 def run_job(default_bucket: str, input_prefix: str, output_prefix: str, months: int,
             only_bucket: str = None, only_key: str = None) -> Dict[str, int]:
     today = date.today()
     threshold = today + timedelta(days=int(round(months * 30.5)))
+    today_iso, threshold_iso = today.isoformat(), threshold.isoformat()
     bkt = only_bucket or default_bucket
 
     total_files = 0
@@ -127,11 +225,21 @@ def run_job(default_bucket: str, input_prefix: str, output_prefix: str, months:
 
     if only_key:
         total_files = 1
-        total_written += process_object(bkt, only_key, output_prefix, threshold, today)
+        total_written += process_object(bkt, only_key, output_prefix, threshold_iso, today_iso)
     else:
-        for key in list_keys(default_bucket, input_prefix):
-            total_files += 1
-            total_written += process_object(default_bucket, key, output_prefix, threshold, today)
+        # S3 GET/PUT latency dominates; overlap objects across threads while keys are still listed
+        # Only a bounded window of futures is kept, so huge prefixes don't pile up in memory
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+            inflight = set()
+            for key in list_keys(default_bucket, input_prefix):
+                if len(inflight) >= MAX_WORKERS * 2:
+                    done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+                    total_written += sum(f.result() for f in done)
+                inflight.add(pool.submit(process_object, default_bucket, key, output_prefix,
+                                         threshold_iso, today_iso))
+                total_files += 1
+            for fut in as_completed(inflight):
+                total_written += fut.result()
 
     logger.info(f"Done. Files scanned: {total_files}, records written: {total_written}")
     return {"files_scanned": total_files, "records_written": total_written}